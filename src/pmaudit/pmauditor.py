@@ -105,17 +105,28 @@ Dump the discovered targets, both intermediate and final:
 
 import argparse
 import collections
-import datetime
+import concurrent.futures
 import fcntl
+import functools
+import itertools
 import json
 import logging
 import os
 import socket
-import stat
 import subprocess
 import sys
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 PROG = os.path.basename(__file__)
 
 CUSTOM = 'custom'
@@ -131,6 +142,7 @@ START_TIME = 'start_time'
 END_TIME = 'end_time'
 PRIOR_COUNT = 'prior_count'
 AFTER_COUNT = 'after_count'
+UNUSED_COUNT = 'unused_count'
 PREREQS = 'prereqs'
 INTERMEDIATES = 'intermediates'
 FINALS = 'finals'
@@ -142,87 +154,411 @@ JSON = 'pmaudit.json'
 # that it must be >1 second to avoid roundoff errors.
 DELTA = 24 * 60 * 60
 
-
-# **NOTE** this is a copy from Python2 os.path.walk() since that function
-# has been removed in Python3 in favor of os.walk(). Unfortunately os.walk()
-# tends to update symlink atimes so it can't be used here.
-def os_path_walk(top, func, arg):
-    """Directory tree walk with callback function.
-
-    For each directory in the directory tree rooted at top (including top
-    itself, but excluding '.' and '..'), call func(arg, dirname, fnames).
-    dirname is the name of the directory, and fnames a list of the names of
-    the files and subdirectories in dirname (excluding '.' and '..').  func
-    may modify the fnames list in-place (e.g. via del or slice assignment),
-    and walk will only recurse into the subdirectories whose names remain in
-    fnames; this can be used to implement a filter, or to impose a specific
-    order of visiting.  No semantics are defined for, or required of, arg,
-    beyond that arg is always passed to func.  It can be used, e.g., to pass
-    a filename pattern, or a mutable object designed to accumulate
-    statistics.  Passing None for arg is common."""
-
-    try:
-        names = os.listdir(top)
-    except OSError:
-        return
-    func(arg, top, names)
-    for name in names:
-        name = os.path.join(top, name)
+# File times are kept as integer nanoseconds so that priming an atime
+# can't perturb the mtime through float rounding and comparisons of
+# before and after times are exact.
+NANOS = 1000000000
+
+# Stat calls release the GIL so metadata I/O scales with threads,
+# especially on network filesystems where each one is a round trip.
+# Files are handed to the threads in batches to keep the per-task
+# overhead well below the cost of the syscalls themselves.
+WORKERS = min(32, (os.cpu_count() or 1) * 4)
+BATCH = 256
+
+
+def scan_dirs(prefixes, exclude, func, ordered=False):
+    """Walk directories for fast_scan() until about BATCH files are done.
+
+    Each prefix names a directory relative to the current one, with a
+    trailing separator (or '' for the current directory itself). They
+    are walked depth-first, calling func(path, entry, dir_fd) for each
+    non-directory found. Returns the non-None results of func along
+    with the prefixes of any directories left unvisited.
+
+    Each directory is opened once and listed through its descriptor, so
+    the entry's stat and anything func does relative to dir_fd resolve
+    just the file name rather than the whole path. If ordered is true
+    each directory's entries are taken in inode order."""
+
+    # Module lookups are bound to locals since the inner loop runs
+    # once per file in the tree.
+    scandir, curdir, sep = os.scandir, os.curdir, os.sep
+    inode = os.DirEntry.inode
+    flags = os.O_RDONLY | os.O_DIRECTORY
+    stack = list(prefixes)
+    push = stack.append
+    results, count = [], 0
+    while stack and count < BATCH:
+        prefix = stack.pop()
         try:
-            st = os.lstat(name)
+            dir_fd = os.open(prefix or curdir, flags)
         except OSError:
             continue
-        if stat.S_ISDIR(st.st_mode):
-            os_path_walk(name, func, arg)
+        try:
+            with scandir(dir_fd) as scanner:
+                # Inode numbers come free with each dirent.
+                for entry in (sorted(scanner, key=inode) if ordered
+                              else scanner):
+                    name = entry.name
+                    if name in exclude:
+                        continue
+                    path = prefix + name
+                    if entry.is_dir(follow_symlinks=False):
+                        push(path + sep)
+                    else:
+                        result = func(path, entry, dir_fd)
+                        if result is not None:
+                            results.append(result)
+                        count += 1
+        finally:
+            os.close(dir_fd)
+    return results, stack
+
+
+def fast_scan(tops, exclude, func, ordered=False):
+    """Walk the trees rooted at tops without following symlinks.
+
+    Calls func(path, entry, dir_fd) for each non-directory found, where
+    path is relative to the current directory, entry is the os.DirEntry
+    returned by os.scandir() and dir_fd is an open descriptor for its
+    directory, and yields each non-None result in no particular order.
+    Directories and files whose names are in exclude are skipped.
+    Nothing here opens or reads a file, and since symlinks are never
+    followed their atimes are left alone too; the entry caches its own
+    stat result so func needn't stat again. The ordered flag is passed
+    on to scan_dirs().
+
+    The walk is spread over a pool of threads which list directories
+    and run func concurrently, since both are dominated by syscalls
+    that release the GIL. Each task handles about BATCH files before
+    splitting what's left of its subtree with another task."""
+
+    # Relative paths are built by concatenation from the relative path
+    # of their directory, which is computed only once for each top.
+    # Tops repeated or nested within another top (other than under an
+    # excluded name) are dropped so that no file is visited twice.
+    prefixes = []
+    updir = os.pardir + os.sep
+    tops = {os.path.relpath(top) for top in tops}
+    for prefix in sorted(('' if top == os.curdir else top + os.sep
+                          for top in tops), key=len):
+        for outer in prefixes:
+            # The current directory ('') doesn't hold '../' paths.
+            if prefix.startswith(outer) and \
+                    (outer or not prefix.startswith(updir)) and \
+                    exclude.isdisjoint(prefix[len(outer):].split(os.sep)):
+                break
+        else:
+            prefixes.append(prefix)
+
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+        pending = {pool.submit(scan_dirs, [prefix], exclude, func, ordered)
+                   for prefix in prefixes}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results, leftover = future.result()
+                half = (len(leftover) + 1) // 2
+                for part in (leftover[:half], leftover[half:]):
+                    if part:
+                        pending.add(pool.submit(scan_dirs, part, exclude,
+                                                func, ordered))
+                yield from results
+
+
+def batched(items, size=BATCH):
+    """Yield successive lists of up to size items from an iterable."""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def concurrent_map(func, items):
+    """Apply func to each item using a pool of threads, in order."""
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+        for results in pool.map(lambda batch: [func(i) for i in batch],
+                                batched(items)):
+            yield from results
+
+
+def prime_entry(path, entry, dir_fd):
+    """Stat a file found by fast_scan(), priming its atime.
+
+    Returns (path, FileState), or (path, None) for a symlink which
+    is neither stat-ed nor primed."""
+    # Paths are interned so finish() can share these strings.
+    if entry.is_symlink():  # Answered from the dirent type, no syscall.
+        return sys.intern(path), None
+    stats = entry.stat(follow_symlinks=False)
+    # Modern Linux won't update atime unless it's
+    # older than mtime (the "relatime" feature).
+    atime, mtime = (stats.st_atime_ns, stats.st_mtime_ns)
+    if atime >= mtime:
+        atime = mtime - DELTA * NANOS
+        os.utime(entry.name, ns=(atime, mtime), dir_fd=dir_fd,
+                 follow_symlinks=False)
+    return sys.intern(path), FileState(atime, mtime, stats.st_size)
+
+
+def lstat_entry(path, entry, dir_fd,  # pylint: disable=unused-argument
+                old_links=frozenset()):
+    """Stat a file found by fast_scan() without priming.
+
+    Returns (path, stats), or None for a symlink to a directory or one
+    whose path is in old_links. Symlinks which predate the build have
+    no prior state, so they'd otherwise look like new targets."""
+    if entry.is_symlink() and (path in old_links or entry.is_dir()):
+        return None
+    return path, entry.stat(follow_symlinks=False)
+
+
+def json_default(obj):
+    """Convert objects the JSON encoders don't know about."""
+    if isinstance(obj, (FileState, AuditState)):
+        return obj.todict()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+# A single reusable encoder; json.dumps() with non-default arguments
+# builds a new one on every call.
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), default=json_default)
+
+
+def json_dumps(data):
+    """Serialize data as compact JSON, using orjson if available.
+
+    The two encoders agree on plain ASCII but orjson writes DEL and
+    non-ASCII characters raw where the stdlib escapes them, so text
+    containing those is left to the stdlib. That way the output is
+    the same whichever encoder is installed."""
+    if orjson:
+        try:
+            text = orjson.dumps(data, default=json_default).decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass  # E.g. undecodable (surrogate-escaped) filenames.
+        else:
+            if text.isascii() and '\x7f' not in text:
+                return text
+    return JSON_ENCODER.encode(data)
+
+
+def json_key(key):
+    """Quote a dict key for JSON output.
+
+    Plain printable ASCII keys, which is nearly every path, need no
+    escaping and are quoted directly rather than run through an encoder.
+    Anything else, including DEL and non-ASCII, goes to json_dumps(),
+    so the result always matches json_dumps(key)."""
+    if key.isascii() and key.isprintable() and \
+            '"' not in key and '\\' not in key:
+        return f'"{key}"'
+    return json_dumps(key)
+
+
+def json_loads(text):
+    """Parse JSON text (str or bytes), using orjson if available."""
+    if orjson:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+def fmt_ns(nsecs):
+    """Format a time in nanoseconds as seconds for JSON output."""
+    return FMT1 % (nsecs / NANOS)
+
+
+@functools.lru_cache(maxsize=1)
+def hostname():
+    """Return the name of this host, looked up once per process."""
+    return socket.gethostname()
 
 
 def time_details(reftime):
-    """Turn reftime into time information for JSON file."""
-    dt = datetime.datetime.utcfromtimestamp(reftime)
-    refstr = dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    return [refstr, FMT1 % reftime]
+    """Turn reftime (in ns) into time information for JSON file."""
+    # Split off the fraction as an integer rather than going through
+    # a float, which can't hold a current time to the nanosecond.
+    secs, nsecs = divmod(reftime, NANOS)
+    refstr = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(secs))
+    return [f'{refstr}.{nsecs // 1000:06d}Z', fmt_ns(reftime)]
+
+
+def flush_one(path):
+    """Force an NFS client to revalidate path by locking it."""
+    with open(path, mode='rb') as f:
+        fcntl.lockf(f.fileno(), fcntl.LOCK_SH, 1, 0, 0)
+        fcntl.lockf(f.fileno(), fcntl.LOCK_UN, 1, 0, 0)
 
 
 def nfs_flush(priors, host=None):
     """Do whatever it takes to force NFS flushing of metadata."""
-    apaths = sorted([os.path.abspath(p)
-                     for p in priors if priors[p]['needflush']])
-    if host and apaths:
-        oldest = int(min((priors[k]['mtime'] for k in priors)))
-        cmd = ['ssh', host, '--', 'xargs', 'touch', '-a', '-t']
+    if not priors:
+        return
+    if host:
+        # Collect the paths to flush and the oldest of their mtimes in
+        # a single pass, resolving relative paths against a cached cwd.
+        cwd = os.path.join(os.getcwd(), '')
+        isabs = os.path.isabs
+        apaths, oldest = [], None
+        for path, pstate in priors.items():
+            apaths.append(path if isabs(path) else cwd + path)
+            if oldest is None or pstate.mtime < oldest:
+                oldest = pstate.mtime
+        apaths.sort()
+        oldest //= NANOS
+        # Let the remote xargs run several touch processes at once.
+        cmd = ['ssh', host, '--', 'xargs', '-0', '-P', str(WORKERS),
+               '-n', '1000', 'touch', '-a', '-t']
         cmd.append(time.strftime('%Y%m%d%H%M', time.localtime(oldest - DELTA)))
         if len(apaths) > 1:
             logging.info('flushing %d files with "%s"',
                          len(apaths), ' '.join(cmd))
         cmd.insert(1, '-oLogLevel=error')
-        touches = '\n'.join(apaths) + '\n'
+        # Paths are streamed to xargs NUL-terminated, so that any legal
+        # file name gets through and the remote end can start early.
         with subprocess.Popen(cmd, stdin=subprocess.PIPE) as proc:
-            proc.stdin.write(touches.encode('utf-8'))
+            proc.stdin.writelines(os.fsencode(apath) + b'\0'
+                                  for apath in apaths)
             proc.stdin.close()
     else:
-        for path in sorted(priors):
-            with open(path, encoding='utf-8') as f:
-                fcntl.lockf(f.fileno(), fcntl.LOCK_SH, 1, 0, 0)
-                fcntl.lockf(f.fileno(), fcntl.LOCK_UN, 1, 0, 0)
+        # Each lock is a server round trip so keep many in flight.
+        # They finish in any order, so there's no point sorting them.
+        list(concurrent_map(flush_one, priors))
+
+
+def probe_atimes(watchdir, flush_host=None, keep_going=False, flush=True):
+    """Figure out how atime updates are handled in watchdir's filesystem.
+
+    Returns True if atimes there only show up after an NFS flush. If
+    flush is False that can't be arranged, so it's treated as an error
+    (unless keep_going) like atimes which don't update at all."""
+    ref_fname = os.path.join(
+        watchdir, f'.{os.path.basename(__file__)}.{os.getpid()}.tmp')
+    with open(ref_fname, mode='w', encoding='utf-8') as f:
+        f.write('data\n')
+        ostats = os.fstat(f.fileno())
+    try:
+        os.utime(ref_fname, ns=(ostats.st_mtime_ns - DELTA * NANOS,
+                                ostats.st_mtime_ns))
+        with open(ref_fname, encoding='utf-8') as f:
+            f.read()
+        nstats = os.stat(ref_fname)
+        needflush = nstats.st_atime < nstats.st_mtime
+        if needflush:
+            apath = os.path.dirname(os.path.abspath(ref_fname))
+            if not flush:
+                msg = f'NFS flush required but disabled in {apath}'
+                if not keep_going:
+                    raise RuntimeError(msg)
+                logging.warning(msg)
+                return needflush
+            nfs_flush({ref_fname: FileState(nstats.st_atime_ns,
+                                            nstats.st_mtime_ns,
+                                            nstats.st_size)},
+                      host=flush_host)
+            with open(ref_fname, encoding='utf-8') as f:
+                f.read()
+            nstats = os.stat(ref_fname)
+            if nstats.st_atime < nstats.st_mtime:
+                msg = f'atimes not updated in {apath}'
+                if not keep_going:
+                    raise RuntimeError(msg)
+                logging.warning(msg)
+            else:
+                logging.info('NFS flush required in %s', apath)
+    finally:
+        os.remove(ref_fname)
+    return needflush
+
+
+def is_rotational(path):
+    """Return True if path is known to live on a spinning disk.
+
+    Only Linux says, through sysfs; anything else is assumed not to."""
+    dev = os.stat(path).st_dev
+    sysdir = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+    # A partition's queue data is found in its parent disk.
+    for queue in ('queue', os.path.join(os.pardir, 'queue')):
+        try:
+            with open(os.path.join(sysdir, queue, 'rotational'),
+                      encoding='utf-8') as f:
+                return f.read().strip() == '1'
+        except OSError:
+            pass
+    return False
+
+
+class FileState(object):
+    """Times (in ns) and size of a file as recorded before the audit."""
+
+    __slots__ = ('atime', 'mtime', 'size')
+
+    def __init__(self, atime, mtime, size):
+        self.atime = atime
+        self.mtime = mtime
+        self.size = size
+
+    def todict(self):
+        """Return the JSON form of this state for an unused file."""
+        return {'atime': [fmt_ns(self.atime), '0'],
+                'mtime': [fmt_ns(self.mtime), '0'],
+                'size': [self.size, self.size]}
+
+
+class AuditState(object):
+    """Prior state (or None) and post-audit times/size of a used file."""
+
+    __slots__ = ('prior', 'atime', 'mtime', 'size')
+
+    def __init__(self, prior, atime, mtime, size):
+        self.prior = prior
+        self.atime = atime
+        self.mtime = mtime
+        self.size = size
+
+    def todict(self):
+        """Return the JSON form of this state."""
+        prior = self.prior
+        if prior is None:
+            return {'atime': ['-2', fmt_ns(self.atime)],
+                    'mtime': ['-1', fmt_ns(self.mtime)],
+                    'size': [None, self.size]}
+        return {'atime': [fmt_ns(prior.atime), fmt_ns(self.atime)],
+                'mtime': [fmt_ns(prior.mtime), fmt_ns(self.mtime)],
+                'size': [prior.size, self.size]}
 
 
 class PMAudit(object):
     """Track files used (prereqs) and generated (targets)."""
 
-    def __init__(self, watchdirs, exclude=None):
+    def __init__(self, watchdirs, exclude=None, record_unused=True):
         self.watchdirs = watchdirs
-        self.exclude = set(['.git', '.svn'])
-        if exclude:
-            self.exclude |= exclude
-        self.prereqs = collections.OrderedDict()
-        self.intermediates = collections.OrderedDict()
-        self.finals = collections.OrderedDict()
-        self.unused = collections.OrderedDict()
+        self.base = os.getcwd()
+        # Names are matched against this in every directory listed,
+        # so it's fixed as a frozenset up front.
+        self.exclude = frozenset(('.git', '.svn', *(exclude or ())))
+        self.prereqs = {}
+        self.intermediates = {}
+        self.finals = {}
+        self.unused = {}
+        # Unused files are usually most of the tree, and may just be
+        # counted instead of recorded.
+        self.record_unused = record_unused
+        self.unused_count = 0
         self.reftime = None
         self.endtime = None
         self.prior = {}
+        self.symlinks = set()  # Pre-existing symlinks, not primed.
+        self.ordered = False
 
-    def start(self, flush_host=None, keep_going=False):
+    def start(self, flush_host=None, keep_going=False, flush=True):
         """
         Start the build audit.
 
@@ -234,68 +570,59 @@ class PMAudit(object):
         Also, due to the introduction of the Linux 'relatime' option
         it's necessary to prime the atime pump before starting. This
         is done by making all atimes a bit earlier than their mtimes.
+
+        When flush is False nothing is flushed, not even the probe's
+        file, and a filesystem which would need flushing is an error
+        unless keep_going.
         """
 
         mkflags = os.getenv('MAKEFLAGS')
         if mkflags and ' -j' in mkflags:
             raise RuntimeError('not supported in -j mode')
 
+        # Filesystems are probed once each, however many watchdirs
+        # they hold, and watchdirs are grouped by whether they'll
+        # need flushing.
+        probed, tops = {}, {False: [], True: []}
         for watchdir in self.watchdirs:
-            # Figure out how atime updates are handled in this filesystem.
-            ref_fname = os.path.join(
-                watchdir, f'.{os.path.basename(__file__)}.{os.getpid()}.tmp')
-            with open(ref_fname, mode='w', encoding='utf-8') as f:
-                f.write('data\n')
-                ostats = os.fstat(f.fileno())
-            os.utime(ref_fname, (ostats.st_mtime - DELTA, ostats.st_mtime))
-            with open(ref_fname, encoding='utf-8') as f:
-                f.read()
-            nstats = os.stat(ref_fname)
-            needflush = nstats.st_atime < nstats.st_mtime
-            if needflush:
-                nfs_flush({ref_fname: {'atime': nstats.st_atime,
-                                       'mtime': nstats.st_mtime,
-                                       'size': nstats.st_size,
-                                       'needflush': True}}, host=flush_host)
-                with open(ref_fname, encoding='utf-8') as f:
-                    f.read()
-                nstats = os.stat(ref_fname)
-                apath = os.path.dirname(os.path.abspath(ref_fname))
-                if nstats.st_atime < nstats.st_mtime:
-                    msg = f'atimes not updated in {apath}'
-                    if not keep_going:
-                        raise RuntimeError(msg)
-                    logging.warning(msg)
-                else:
-                    logging.info('NFS flush required in %s', apath)
-            os.remove(ref_fname)
+            dev = os.stat(watchdir).st_dev
+            if dev not in probed:
+                probed[dev] = probe_atimes(watchdir, flush_host=flush_host,
+                                           keep_going=keep_going,
+                                           flush=flush)
+            tops[probed[dev] and flush].append(watchdir)
+
+        # On spinning disks files are visited in inode order (within each
+        # directory) to cut down on seeking.
+        self.ordered = any(map(is_rotational, self.watchdirs))
+
+        # Every file is stat-ed and primed afresh on each run. Reusing
+        # a previous scan for directories whose mtime hasn't changed
+        # would be unsafe: rewriting a file in place doesn't touch its
+        # directory, and files read by the last build need their
+        # atimes pushed back behind their mtimes again regardless.
+        flushes = {}
+        for needflush, watchdirs in tops.items():
+            for path, pstate in fast_scan(
+                    watchdirs, self.exclude, prime_entry, self.ordered):
+                if pstate is None:
+                    self.symlinks.add(path)
+                    continue
+                self.prior[path] = pstate
+                if needflush:
+                    flushes[path] = pstate
 
-            for parent, dnames, fnames in os.walk(watchdir):
-                dnames[:] = (dn for dn in dnames if dn not in self.exclude)
-                for fname in fnames:
-                    if fname in self.exclude:
-                        continue
-                    path = os.path.relpath(os.path.join(parent, fname))
-                    if os.path.islink(path):
-                        continue
-                    # Modern Linux won't update atime unless it's
-                    # older than mtime (the "relatime" feature).
-                    stats = os.stat(path)
-                    atime, mtime = (stats.st_atime, stats.st_mtime)
-                    if atime >= mtime:
-                        atime = mtime - DELTA
-                        os.utime(path, (atime, mtime))
-                    self.prior[path] = {'atime': atime,
-                                        'mtime': mtime,
-                                        'size': stats.st_size,
-                                        'needflush': needflush}
-
-        nfs_flush(self.prior, host=flush_host)
-
-        self.reftime = time.time()
+        # Filesystems which update atimes on their own need no flush.
+        nfs_flush(flushes, host=flush_host)
+
+        self.reftime = time.time_ns()
 
     def finish(self, cmd=None, final_cmd=None):
-        """End the audit, return the result."""
+        """End the audit, return the result.
+
+        Per-file entries in the result are FileState and AuditState
+        objects rather than plain dicts, so it must be written out with
+        dump_db() or serialized with default=json_default."""
 
         # Record the set of surviving files with their times,
         # dividing them into the standard categories.
@@ -303,94 +630,85 @@ class PMAudit(object):
         # "pre-atime,pre-mtime,post-atime,post-mtime".
         # This data isn't needed once files have been categorized
         # but may be helpful in analysis or debugging.
-        # Note: we can't use os.walk() for this because it has a
-        # way of updating symlink atimes.
+        # Note: fast_scan() never follows symlinks so it won't
+        # update their atimes the way os.walk() can. Symlinks which
+        # existed before the build are left out, but new ones are
+        # reported as targets like any other file.
         prereqs, intermediates, finals, unused = {}, {}, {}, {}
-
-        def visit(prunedirs, parent, fnames):
-            """Callback function for os_path_walk() to categorize files."""
-            for prunedir in prunedirs:
-                if parent.startswith(prunedir):
-                    return
-            if os.path.basename(parent) in self.exclude:
-                prunedirs.add(parent + os.sep)
-                return
-            for fname in fnames:
-                if fname in self.exclude:
-                    continue
-                path = os.path.relpath(os.path.join(parent, fname))
-                if os.path.isdir(path):
-                    continue
-                stats = os.lstat(path)
-                atime, mtime = stats.st_atime, stats.st_mtime
-                pstate = self.prior.get(path)
-                if pstate:
-                    if atime > pstate['atime']:
-                        val = {'atime': [FMT1 % pstate['atime'], FMT1 % atime],
-                               'mtime': [FMT1 % pstate['mtime'], FMT1 % mtime],
-                               'size': [pstate['size'], stats.st_size]}
-                        if mtime > pstate['mtime']:
-                            if mtime > atime:
-                                finals[path] = val
-                                msg = 'pre-existing file is final'
-                            else:
-                                intermediates[path] = val
-                                msg = 'pre-existing file is target'
-                            logging.info('%s: %s', msg, path)
+        intern, prior_get = sys.intern, self.prior.get
+        record_unused, unused_count = self.record_unused, 0
+
+        # Entries are kept as slotted objects, formatted only when
+        # written out, and pre-existing paths share the strings
+        # interned by start().
+        lstat_new = functools.partial(lstat_entry,
+                                      old_links=frozenset(self.symlinks))
+        for path, stats in fast_scan(self.watchdirs, self.exclude,
+                                     lstat_new, self.ordered):
+            path = intern(path)
+            atime, mtime = stats.st_atime_ns, stats.st_mtime_ns
+            pstate = prior_get(path)
+            if pstate:
+                patime, pmtime = pstate.atime, pstate.mtime
+                # Most files in a tree are untouched by any one build,
+                # so settle that case before anything else.
+                if atime <= patime and mtime <= pmtime:
+                    if record_unused:
+                        unused[path] = pstate
+                    else:
+                        unused_count += 1
+                elif atime > patime:
+                    val = AuditState(pstate, atime, mtime, stats.st_size)
+                    if mtime > pmtime:
+                        if mtime > atime:
+                            finals[path] = val
+                            msg = 'pre-existing file is final'
                         else:
-                            prereqs[path] = val
-                    elif mtime > pstate['mtime']:
-                        val = {'atime': [FMT1 % pstate['atime'], FMT1 % atime],
-                               'mtime': [FMT1 % pstate['mtime'], FMT1 % mtime],
-                               'size': [pstate['size'], stats.st_size]}
-                        finals[path] = val
-                        logging.info('pre-existing file modified: %s', path)
+                            intermediates[path] = val
+                            msg = 'pre-existing file is target'
+                        logging.info('%s: %s', msg, path)
                     else:
-                        val = {'atime': [FMT1 % pstate['atime'], '0'],
-                               'mtime': [FMT1 % pstate['mtime'], '0'],
-                               'size': [pstate['size'], pstate['size']]}
-                        unused[path] = val
-                        continue
+                        prereqs[path] = val
                 else:
-                    val = {'atime': ['-2', FMT1 % atime],
-                           'mtime': ['-1', FMT1 % mtime],
-                           'size': [None, stats.st_size]}
-                    if mtime < atime:
-                        intermediates[path] = val
-                    else:
-                        finals[path] = val
-
-        for watchdir in self.watchdirs:
-            os_path_walk(watchdir, visit, set())  # pylint: disable=no-member
+                    finals[path] = AuditState(pstate, atime, mtime,
+                                              stats.st_size)
+                    logging.info('pre-existing file modified: %s', path)
+            else:
+                val = AuditState(None, atime, mtime, stats.st_size)
+                if mtime < atime:
+                    intermediates[path] = val
+                else:
+                    finals[path] = val
 
         # Sort the data just derived. Not needed but helps readability.
-        for k in sorted(prereqs):
-            self.prereqs[k] = prereqs[k]
-        for k in sorted(intermediates):
-            self.intermediates[k] = intermediates[k]
-        for k in sorted(finals):
-            self.finals[k] = finals[k]
-        for k in sorted(unused):
-            self.unused[k] = unused[k]
-
-        # Build up and return a serializable database.
+        # Plain dicts keep insertion order so each is built in one go.
+        self.prereqs = dict(sorted(prereqs.items()))
+        self.intermediates = dict(sorted(intermediates.items()))
+        self.finals = dict(sorted(finals.items()))
+        self.unused = dict(sorted(unused.items()))
+        self.unused_count = len(self.unused) if record_unused else unused_count
+
+        # Build up and return the database. Its per-file entries are
+        # converted by json_default() only as they're serialized.
         root = collections.OrderedDict()
-        root[HOSTNAME] = socket.gethostname()
-        root[BASE] = os.getcwd()
+        root[HOSTNAME] = hostname()
+        root[BASE] = self.base
         root[CMD] = str(cmd)
         root[FINAL_CMD] = final_cmd
         root[START_TIME] = time_details(self.reftime)
-        root[PRIOR_COUNT] = str(len(self.prior))
-        after_count = len(self.prereqs) + len(self.intermediates) + \
-            len(self.finals) + len(self.unused)
-        root[AFTER_COUNT] = str(after_count)
+        root[PRIOR_COUNT] = len(self.prior)
+        root[AFTER_COUNT] = self.unused_count + sum(map(len, (
+            self.prereqs, self.intermediates, self.finals)))
+        if not self.record_unused:
+            # Marks the empty unused category as not recorded.
+            root[UNUSED_COUNT] = self.unused_count
         root[DB] = collections.OrderedDict()
         root[DB][PREREQS] = self.prereqs
         root[DB][INTERMEDIATES] = self.intermediates
         root[DB][FINALS] = self.finals
         root[DB][UNUSED] = self.unused
 
-        self.endtime = time.time()
+        self.endtime = time.time_ns()
         root[END_TIME] = time_details(self.endtime)
 
         return root
@@ -399,40 +717,134 @@ class PMAudit(object):
 def dump_json(data, filename):
     """Generate and store JSON data with control over formatting."""
 
+    def is_nested(data):
+        """Return True if data is a dict to be spread over lines."""
+        return data and isinstance(data, dict) and 'atime' not in data
+
     def json_dump_flat(data, open_file, current=0, indent=2):
         """Perform json.dump but display each list as a single line."""
         # Unfortunately json.dump() provides very little formatting control
         # so we'll just re-implement what we need.
         # We assume starting indentation (if needed) has already occurred.
-        if data and isinstance(data, dict) and 'atime' not in data:
+        if is_nested(data):
             open_file.write(LB + '\n')
             new_indent = current + indent
             indent_text = new_indent * ' '
-            first = True
-            for key in data:
-                if not first:  # Add separator (comma) and new line
-                    open_file.write(',\n')
-                open_file.write(indent_text)
-                open_file.write(json.dumps(key))
-                open_file.write(': ')
-                json_dump_flat(data[key], open_file, new_indent, indent)
-                first = False
-            open_file.write('\n')  # End last line
-            open_file.write(current * ' ')
-            open_file.write(RB)
+            # Separator (comma) and new line go before all but the first.
+            seps = itertools.chain([''], itertools.repeat(',\n'))
+            if any(map(is_nested, data.values())):
+                for sep, key in zip(seps, data):
+                    open_file.write(f'{sep}{indent_text}{json_key(key)}: ')
+                    json_dump_flat(data[key], open_file, new_indent, indent)
+            else:
+                # The common case of a dict full of per-file entries
+                # is streamed with a single writelines() call.
+                open_file.writelines(
+                    f'{sep}{indent_text}{json_key(k)}: {json_dumps(v)}'
+                    for sep, (k, v) in zip(seps, data.items()))
+            open_file.write('\n' + current * ' ' + RB)  # End last line
             # Lists have no long dicts so re-implementation isn't needed.
             # Instead, everything *but* dicts are forced onto a single line.
         else:
-            json.dump(data, open_file)
+            open_file.write(json_dumps(data))
 
     os.makedirs(os.path.dirname(filename) or os.curdir, exist_ok=True)
-    with open(filename, mode='w', encoding='utf-8') as f:
+    # Entries are streamed one at a time through a large buffer so
+    # no serialized copy of the whole database is held in memory.
+    with open(filename, mode='w', encoding='utf-8', buffering=1 << 20) as f:
         # We don't use json.dump() directly because it produces
         # many multi-line lists.
         json_dump_flat(data, f)
         f.write('\n')
 
 
+def dump_db(data, filename, fmt='json'):
+    """Store audit data in the requested format (json or msgpack)."""
+    if fmt != 'msgpack':
+        dump_json(data, filename)
+        return
+    packer = msgpack.Packer(use_bin_type=True, default=json_default,
+                            unicode_errors='surrogateescape')
+
+    def pack_flat(data):
+        """Yield data packed a piece at a time, like json_dump_flat()."""
+        if isinstance(data, dict) and 'atime' not in data:
+            yield packer.pack_map_header(len(data))
+            for key, value in data.items():
+                yield packer.pack(key)
+                yield from pack_flat(value)
+        else:
+            yield packer.pack(data)
+
+    os.makedirs(os.path.dirname(filename) or os.curdir, exist_ok=True)
+    # Entries are streamed out one at a time, as in dump_json().
+    with open(filename, mode='wb', buffering=1 << 20) as f:
+        f.writelines(pack_flat(data))
+
+
+def json_categories(raw, names):
+    """Parse just the named db categories out of dump_json() output.
+
+    Relies on the layout dump_json() produces, in which each category
+    sits on its own line at a fixed indentation, to skip over the
+    categories not asked for. The root entries which come before the
+    db are parsed too. Returns None if the layout isn't found."""
+    db_start = raw.find(b'\n  "%s": {\n' % DB.encode())
+    if db_start < 0:
+        return None
+    db_end = raw.find(b'\n  }', db_start)
+    db = {}
+    for name in names:
+        key = b'\n    "%s": ' % name.encode()
+        start = raw.find(key, db_start, db_end)
+        if start < 0:
+            return None
+        start += len(key)
+        if raw.startswith(b'{}', start):
+            db[name] = {}
+            continue
+        # A category can be squeezed onto one line (dump_json() does
+        # that to one holding a file named "atime"), in which case
+        # the layout can't be relied on.
+        if not raw.startswith(b'{\n', start):
+            return None
+        end = raw.find(b'\n    }', start, db_end)
+        if end < 0:
+            return None
+        try:
+            db[name] = json_loads(raw[start:end + len(b'\n    }')])
+        except ValueError:
+            return None
+    # Everything before the db is a short run of one-line entries.
+    try:
+        root = json_loads(raw[:db_start].rstrip(b',') + b'\n}')
+    except ValueError:
+        return None
+    root[DB] = db
+    return root
+
+
+def load_db(filename, categories=None):
+    """Read audit data written by dump_db(), in whichever format.
+
+    If a list of db categories is given, only those are guaranteed
+    to be present and JSON files are parsed only that far."""
+    with open(filename, mode='rb') as f:
+        raw = f.read()
+    # A JSON database always starts with a brace; anything else
+    # must be a MessagePack map.
+    if raw[:1] == LB.encode():
+        if categories:
+            root = json_categories(raw, categories)
+            if root is not None:
+                return root
+        return json_loads(raw)
+    if not msgpack:
+        raise RuntimeError(f'{filename}: reading a msgpack database '
+                           'requires the msgpack module')
+    return msgpack.unpackb(raw, raw=False, unicode_errors='surrogateescape')
+
+
 def custom_results(entries):
     """Convert a list of key=value pairs into a dictionary."""
     result = {}
@@ -472,13 +884,20 @@ def main():
     parser.add_argument(
         '--flush-host',
         help="a second host from which to force client flushes")
+    parser.add_argument(
+        '--format', choices=('json', 'msgpack'),
+        help="format of saved audit data (default=msgpack if FILE "
+        "ends in .msgpack, else json)")
     parser.add_argument(
         '-j', '--json',  # default='%s.json' % PROG
         metavar='FILE',
-        help="save audit data in JSON format to FILE")
+        help="save audit data to FILE (see --format)")
     parser.add_argument(
         '-k', '--keep-going', action='store_true',
         help="continue even if atimes aren't updated")
+    parser.add_argument(
+        '--no-nfs-flush', action='store_false', dest='nfs_flush',
+        help="never flush NFS; fail (unless -k) where a flush is needed")
     parser.add_argument(
         '--multiline', action='store_true',
         help="separately run each line in the -c string")
@@ -513,9 +932,18 @@ def main():
     parser.add_argument(
         '--shellflags', default='-c',
         help="space-separated flags to pass to shell (default=%(default)s)")
+    parser.add_argument(
+        '--skip-unused', action='store_true',
+        help="count unused files instead of listing them in audit data")
 
     opts, unparsed = parser.parse_known_args()
 
+    if not opts.format:
+        opts.format = 'msgpack' if opts.json and \
+            opts.json.endswith('.msgpack') else 'json'
+    if opts.format == 'msgpack' and not msgpack:
+        parser.error('msgpack output requires the msgpack module')
+
     # Configure logging.
     logging.basicConfig(
         format=PROG + ': %(levelname)s: %(message)s',
@@ -560,8 +988,10 @@ def main():
             exclude_set.add(opts.json)
         if opts.depsfile:
             exclude_set.add(opts.depsfile)
-        audit = PMAudit(wdirs, exclude=exclude_set)
-        audit.start(flush_host=opts.flush_host, keep_going=opts.keep_going)
+        audit = PMAudit(wdirs, exclude=exclude_set,
+                        record_unused=not opts.skip_unused)
+        audit.start(flush_host=opts.flush_host, keep_going=opts.keep_going,
+                    flush=opts.nfs_flush)
         for cmd in cmds:  # Execute each line in sequence.
             rc = subprocess.call(cmd)
             # Stop if we get an error.  Note that "make" does this *even*
@@ -575,15 +1005,20 @@ def main():
             prqs = adb[DB][PREREQS]
             # *Always* create depsfile, even if prqs is empty.
             os.makedirs(os.path.dirname(opts.depsfile), exist_ok=True)
+            # The rule and the empty per-prereq rules are assembled
+            # in one pass over prqs and written out together.
+            deps, rules = [], []
+            for prq in prqs:
+                deps.append(f'  {prq}')
+                rules.append(f'\n{prq}:\n')
+            if deps:
+                deps[-1] += '\n'
+            text = ''.join([os.path.splitext(opts.depsfile)[0], ': \\\n',
+                            ' \\\n'.join(deps)] + rules)
             with open(opts.depsfile, mode='w', encoding='utf-8') as f:
-                f.write(os.path.splitext(opts.depsfile)[0] + ': \\\n')
-                for i, prq in enumerate(prqs):
-                    eol = ' \\\n' if i < len(prqs) - 1 else '\n'
-                    f.write(f'  {prq}{eol}')
-                for prq in prqs:
-                    f.write(f'\n{prq}:\n')
+                f.write(text)
         if opts.json:
-            dump_json(adb, opts.json)
+            dump_db(adb, opts.json, fmt=opts.format)
         sys.exit(2 if rc else 0)
 
     # Don't analyze, e.g., report from an existing audit log.
@@ -595,32 +1030,36 @@ def main():
         help="query audit data from FILE (default=%(default)s)")
     opts = parser.parse_args()
 
-    with open(opts.dbfile, encoding='utf-8') as f:
-        root = json.load(f)
-    db = root[DB]
-
     if opts.all_involved:
         opts.prerequisites = opts.intermediates = opts.final_targets = True
     elif opts.targets:
         opts.intermediates = opts.final_targets = True
 
-    results = {}
+    # Only the categories asked for are parsed.
+    wanted = [name for name, want in ((INTERMEDIATES, opts.intermediates),
+                                      (PREREQS, opts.prerequisites),
+                                      (FINALS, opts.final_targets),
+                                      (UNUSED, opts.unused)) if want]
+    try:
+        root = load_db(opts.dbfile, categories=wanted)
+    except RuntimeError as exc:
+        parser.error(str(exc))
+    if opts.unused and UNUSED_COUNT in root:
+        parser.error(f'{opts.dbfile}: unused files were only counted '
+                     f'({root[UNUSED_COUNT]}), not recorded')
+    db = root[DB]
 
-    if opts.intermediates:
-        results.update(db[INTERMEDIATES])
-    if opts.prerequisites:
-        results.update(db[PREREQS])
-    if opts.final_targets:
-        results.update(db[FINALS])
-    if opts.unused:
-        results.update(db[UNUSED])
+    results = {}
+    for name in wanted:
+        results.update(db[name])
 
     def by_atime(item):
         """Sort by post-atime."""
         return float(item[1]['atime'][1])
 
-    for path in [k for k, _ in sorted(results.items(), key=by_atime)]:
-        print(path)
+    # Emit everything with one write rather than a print() per path.
+    sys.stdout.write(''.join(f'{path}\n' for path, _ in
+                             sorted(results.items(), key=by_atime)))
 
 # Local Variables:
 # mode: Python